@@ -1,25 +1,53 @@
+import asyncio
+import functools
 import os
+import time
 import typing
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
 from typing import TYPE_CHECKING
-from urllib import parse, request
+from urllib import parse
 
+import aiohttp
 import boto3
 from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
-from boto3.dynamodb.conditions import Attr
-from botocore.client import ClientError
-from bs4 import BeautifulSoup, Tag
+from boto3.dynamodb.table import BatchWriter
+from botocore.config import Config
+from selectolax.lexbor import LexborHTMLParser, LexborNode
 
 if TYPE_CHECKING:
-    from mypy_boto3_dynamodb.service_resource import Table
+    from mypy_boto3_dynamodb.service_resource import (
+        DynamoDBServiceResource,
+        Table,
+    )
 else:
+    DynamoDBServiceResource = object
     Table = object
 
 logger = Logger()
 
+# Upper bound of concurrent DynamoDB writers; the client connection pool is
+# sized to match so that no worker waits on or discards a connection.
+DYNAMODB_MAX_CONCURRENCY = 16
+
+# Retries of unprocessed BatchGetItem keys, with exponential backoff
+# starting at BATCH_GET_BACKOFF_BASE seconds.
+BATCH_GET_MAX_RETRIES = 8
+BATCH_GET_BACKOFF_BASE = 0.05
 
-@dataclass
+
+@functools.lru_cache(maxsize=None)
+def _get_dynamodb() -> DynamoDBServiceResource:
+    # Created on first use and kept for the lifetime of the module so that
+    # warm Lambda invocations skip the client setup.
+    return boto3.resource(
+        "dynamodb",
+        config=Config(max_pool_connections=DYNAMODB_MAX_CONCURRENCY),
+    )
+
+
+@dataclass(slots=True)
 class RoomInfo:
     id: str
     image_urls: typing.List[str]
@@ -32,7 +60,7 @@ class RoomInfo:
     area: str
 
 
-@dataclass
+@dataclass(slots=True)
 class BuildingInfo:
     name: str
     image_url: str
@@ -44,79 +72,145 @@ class BuildingInfo:
 
 
 class SuumoScraper:
-    def __init__(self, entry_url: str) -> None:
+    def __init__(self, entry_url: str, concurrency: int = 8) -> None:
         self.parsed_url = parse.urlparse(entry_url)
         self.params = [
             (k, v)
             for k, v in parse.parse_qsl(self.parsed_url.query)
             if k != "page"
         ]
+        # Only the page number changes between requests, so build the rest
+        # of the URL once and append the page to it.
+        query = parse.urlencode(self.params + [("page", "")])
+        self.page_url_prefix = parse.urlunparse(
+            self.parsed_url._replace(query=query, fragment="")
+        )
+        # Listings per page ("pc"); SUUMO shows 30 unless told otherwise.
+        page_size = dict(self.params).get("pc", "")
+        self.page_size = int(page_size) if page_size.isdecimal() else 30
+        self.concurrency = concurrency
 
     def scrape(self) -> typing.List[BuildingInfo]:
         logger.info("scraping...")
 
-        page = 1
-        building_infos: typing.List[BuildingInfo] = []
-        while infos := self._scrape_page(page):
-            building_infos.extend(infos)
-            page += 1
+        building_infos = asyncio.run(self._scrape_async())
 
         logger.info(f"{len(building_infos)} buildings were found.")
 
         return building_infos
 
-    def _scrape_page(self, page: int) -> typing.List[BuildingInfo]:
-        query = "&".join(
-            [f"{k}={v}" for k, v in self.params] + [f"page={page}"]
-        )
-        url = parse.urlunparse(self.parsed_url._replace(query=query))
+    async def _scrape_async(self) -> typing.List[BuildingInfo]:
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            html = await self._fetch_page(session, 1)
+            building_infos, total_pages = await asyncio.to_thread(
+                self._parse_first_page, html
+            )
+
+            if total_pages is None:
+                if len(building_infos) >= self.page_size:
+                    logger.warning(
+                        "The first page is full but has no pagination; "
+                        "only the first page is scraped."
+                    )
+                total_pages = 1
+
+            logger.info(f"{total_pages} pages were found.")
+
+            # The first page tells how many pages there are, so the rest can
+            # be requested at once; the connector bounds the concurrency.
+            results = await asyncio.gather(
+                *[
+                    self._scrape_page(session, page)
+                    for page in range(2, total_pages + 1)
+                ]
+            )
+            for infos in results:
+                building_infos.extend(infos)
+
+        return building_infos
+
+    async def _scrape_page(
+        self,
+        session: aiohttp.ClientSession,
+        page: int,
+    ) -> typing.List[BuildingInfo]:
+        html = await self._fetch_page(session, page)
+        # Parse in a worker thread so that other pages keep downloading.
+        return await asyncio.to_thread(self._parse_page, html)
+
+    async def _fetch_page(
+        self,
+        session: aiohttp.ClientSession,
+        page: int,
+    ) -> bytes:
+        url = f"{self.page_url_prefix}{page}"
 
         logger.debug(url)
 
-        soup = BeautifulSoup(request.urlopen(url), "html.parser")
+        async with session.get(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+    def _parse_first_page(
+        self,
+        html: bytes,
+    ) -> typing.Tuple[typing.List[BuildingInfo], typing.Optional[int]]:
+        tree = LexborHTMLParser(html)
+        return self._parse_buildings(tree), self._parse_total_pages(tree)
+
+    def _parse_page(self, html: bytes) -> typing.List[BuildingInfo]:
+        return self._parse_buildings(LexborHTMLParser(html))
 
+    def _parse_buildings(
+        self,
+        tree: LexborHTMLParser,
+    ) -> typing.List[BuildingInfo]:
         building_infos = [
-            self._scrape_building(building_tag)
-            for building_tag in soup.find_all("div", class_="cassetteitem")
+            self._scrape_building(building_node)
+            for building_node in tree.css("div.cassetteitem")
         ]
 
         return building_infos
 
-    def _scrape_building(self, building_tag: Tag) -> BuildingInfo:
+    def _parse_total_pages(
+        self,
+        tree: LexborHTMLParser,
+    ) -> typing.Optional[int]:
+        # The pagination lists the first and last page numbers, possibly
+        # with an ellipsis in between. None means no pagination was found.
+        page_numbers = [
+            int(text)
+            for node in tree.css("ol.pagination-parts li")
+            if (text := node.text(strip=True)).isdecimal()
+        ]
+        return max(page_numbers, default=None)
+
+    def _scrape_building(self, building_node: LexborNode) -> BuildingInfo:
         room_infos = [
-            self._scrape_room(room_tag)
-            for room_tag in building_tag.find(
-                "div", class_="cassetteitem-item"
-            ).find_all("tbody")
+            self._scrape_room(room_node)
+            for room_node in building_node.css("div.cassetteitem-item tbody")
         ]
 
+        title_node = building_node.css_first("div.cassetteitem_content-title")
+        address_node = building_node.css_first("li.cassetteitem_detail-col1")
+        col3_divs = building_node.css("li.cassetteitem_detail-col3 div")
+
+        # Only the leaf elements holding a single text node are read with
+        # deep=False; the title and address may wrap parts of their text in
+        # child elements, so they collect the text of the whole subtree.
         building_info = BuildingInfo(
-            name=building_tag.find(
-                "div",
-                class_="cassetteitem_content-title",
-            ).text,
-            image_url=building_tag.find(
-                "div", class_="cassetteitem_object-item"
-            ).find("img")["rel"],
-            address=building_tag.find(
-                "li", class_="cassetteitem_detail-col1"
-            ).text,
+            name=title_node.text(),
+            image_url=building_node.css_first(
+                "div.cassetteitem_object-item img"
+            ).attributes["rel"],
+            address=address_node.text(),
             accesses=[
-                tag.text.strip()
-                for tag in building_tag.find_all(
-                    "div", class_="cassetteitem_detail-text"
-                )
+                node.text(deep=False, strip=True)
+                for node in building_node.css("div.cassetteitem_detail-text")
             ],
-            age=(
-                building_tag.find("li", class_="cassetteitem_detail-col3")
-                .find_all("div")[0]
-                .text.strip()
-            ),
-            floor=(
-                building_tag.find("li", class_="cassetteitem_detail-col3")
-                .find_all("div")[1]
-                .text.strip()
-            ),
+            age=col3_divs[0].text(deep=False, strip=True),
+            floor=col3_divs[1].text(deep=False, strip=True),
             room_infos=room_infos,
         )
 
@@ -124,31 +218,30 @@ class SuumoScraper:
 
         return building_info
 
-    def _scrape_room(self, room_tag: Tag) -> RoomInfo:
+    def _scrape_room(self, room_node: LexborNode) -> RoomInfo:
+        # Collect every price in one pass, keyed by its class suffix
+        # (e.g. "cassetteitem_price--rent" -> "rent").
+        prices: typing.Dict[str, str] = {}
+        for price_node in room_node.css("span.cassetteitem_price"):
+            for class_ in (price_node.attributes.get("class") or "").split():
+                if class_.startswith("cassetteitem_price--"):
+                    key = class_.removeprefix("cassetteitem_price--")
+                    prices[key] = price_node.text(strip=True)
+
         room_info = RoomInfo(
-            id=room_tag.find("input").get("value"),
-            image_urls=room_tag.find(
-                "div", class_="casssetteitem_other-thumbnail"
-            )
-            .get("data-imgs")
+            id=room_node.css_first("input").attributes.get("value"),
+            image_urls=room_node.css_first("div.casssetteitem_other-thumbnail")
+            .attributes.get("data-imgs")
             .split(","),
-            floor=room_tag.find_all("td")[2].text.strip(),
-            price_rent=room_tag.find(
-                "span", class_="cassetteitem_price--rent"
-            ).text.strip(),
-            price_maintenance=room_tag.find(
-                "span", class_="cassetteitem_price--administration"
-            ).text.strip(),
-            price_deposit=room_tag.find(
-                "span", class_="cassetteitem_price--deposit"
-            ).text.strip(),
-            price_gratuity=room_tag.find(
-                "span", class_="cassetteitem_price--gratuity"
-            ).text.strip(),
-            section_type=room_tag.find(
-                "span", class_="cassetteitem_madori"
-            ).text.strip(),
-            area=room_tag.find("span", class_="cassetteitem_menseki").text,
+            floor=room_node.css("td")[2].text(deep=False, strip=True),
+            price_rent=prices["rent"],
+            price_maintenance=prices["administration"],
+            price_deposit=prices["deposit"],
+            price_gratuity=prices["gratuity"],
+            section_type=room_node.css_first("span.cassetteitem_madori").text(
+                deep=False, strip=True
+            ),
+            area=room_node.css_first("span.cassetteitem_menseki").text(),
         )
 
         logger.debug(room_info)
@@ -161,50 +254,134 @@ class RoomInfoRegister:
         self,
         building_infos: typing.List[BuildingInfo],
         table_name: str,
+        concurrency: int = DYNAMODB_MAX_CONCURRENCY,
     ) -> None:
         self.building_infos = building_infos
         self.table = self._get_table(table_name)
+        self.concurrency = min(concurrency, DYNAMODB_MAX_CONCURRENCY)
 
     def _get_table(self, table_name: str) -> Table:
-        dynamodb = boto3.resource("dynamodb")
-        table = dynamodb.Table(table_name)
-        return table
+        return _get_dynamodb().Table(table_name)
 
     def register(self) -> None:
         logger.info("register...")
 
+        existing_ids = self._get_existing_ids(
+            [
+                room_info.id
+                for building_info in self.building_infos
+                for room_info in building_info.room_infos
+            ]
+        )
+
+        # Keyed by id so that a room listed twice is only written once.
+        new_rooms: typing.Dict[
+            str, typing.Tuple[RoomInfo, typing.Dict[str, typing.Any]]
+        ] = {}
         for building_info in self.building_infos:
+            # Serialized once and shared by every room of the building.
+            building_info_dict = self._to_dict(
+                building_info, exclude=("room_infos",)
+            )
             for room_info in building_info.room_infos:
+                if room_info.id not in existing_ids:
+                    new_rooms[room_info.id] = (room_info, building_info_dict)
+        rooms = list(new_rooms.values())
+
+        # Each worker writes one BatchWriteItem sized chunk of rooms.
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = []
+            for start in range(0, len(rooms), 25):
+                end = start + 25
+                chunk = rooms[start:end]
+                futures.append(
+                    executor.submit(self._register_room_infos, chunk)
+                )
+            for future in futures:
+                future.result()
+
+    def _register_room_infos(
+        self,
+        rooms: typing.List[
+            typing.Tuple[RoomInfo, typing.Dict[str, typing.Any]]
+        ],
+    ) -> None:
+        # Resources are not thread-safe, so each worker builds its writer on
+        # the underlying client, which is.
+        with BatchWriter(
+            self.table.name,
+            self.table.meta.client,
+            overwrite_by_pkeys=["id"],
+        ) as writer:
+            for room_info, building_info_dict in rooms:
                 self._register_room_info(
+                    writer=writer,
                     room_info=room_info,
-                    building_info=building_info,
+                    building_info_dict=building_info_dict,
                 )
 
+    def _get_existing_ids(self, ids: typing.List[str]) -> typing.Set[str]:
+        # BatchGetItem rejects duplicated keys and accepts up to 100 keys.
+        unique_ids = list(dict.fromkeys(ids))
+
+        existing_ids: typing.Set[str] = set()
+        for start in range(0, len(unique_ids), 100):
+            end = start + 100
+            request_items = {
+                self.table.name: {
+                    "Keys": [{"id": id_} for id_ in unique_ids[start:end]],
+                    "ProjectionExpression": "id",
+                },
+            }
+            # Keys left unprocessed must be retried, otherwise existing
+            # rooms would be taken as new ones and overwritten. They are
+            # returned while the table is throttled, so back off first.
+            for attempt in range(BATCH_GET_MAX_RETRIES + 1):
+                if attempt:
+                    time.sleep(BATCH_GET_BACKOFF_BASE * 2 ** (attempt - 1))
+                res = self.table.meta.client.batch_get_item(
+                    RequestItems=request_items,
+                )
+                existing_ids.update(
+                    item["id"] for item in res["Responses"][self.table.name]
+                )
+                request_items = res.get("UnprocessedKeys")
+                if not request_items:
+                    break
+            else:
+                raise RuntimeError(
+                    "BatchGetItem left keys unprocessed after "
+                    f"{BATCH_GET_MAX_RETRIES} retries."
+                )
+
+        return existing_ids
+
+    def _to_dict(
+        self,
+        info: typing.Union[RoomInfo, BuildingInfo],
+        exclude: typing.Tuple[str, ...] = (),
+    ) -> typing.Dict[str, typing.Any]:
+        # Shallow counterpart of dataclasses.asdict: the values are only
+        # read by the serializer, so deep-copying them is wasted work.
+        return {
+            field.name: getattr(info, field.name)
+            for field in fields(info)
+            if field.name not in exclude
+        }
+
     def _register_room_info(
         self,
+        writer: BatchWriter,
         room_info: RoomInfo,
-        building_info: BuildingInfo,
+        building_info_dict: typing.Dict[str, typing.Any],
     ) -> None:
-        building_info_dict = building_info.__dict__
-        del building_info_dict["room_infos"]
-
-        try:
-            self.table.put_item(
-                Item={
-                    "id": room_info.id,
-                    "room_info": room_info.__dict__,
-                    "building_info": building_info_dict,
-                },
-                ConditionExpression=Attr("id").not_exists(),
-            )
-        except ClientError as e:
-            if (
-                e.response["Error"]["Code"]
-                == "ConditionalCheckFailedException"  # noqa
-            ):
-                pass
-            else:
-                raise (e)
+        writer.put_item(
+            Item={
+                "id": room_info.id,
+                "room_info": self._to_dict(room_info),
+                "building_info": building_info_dict,
+            },
+        )
 
 
 def main(entry_url: str, table_name: str) -> None:
@@ -1,13 +1,16 @@
+import asyncio
+import dataclasses
 import os
 import typing
 
 import boto3
 import pytest
-from bs4 import BeautifulSoup, Tag
 from moto import mock_dynamodb
 from pytest_mock import MockerFixture
+from selectolax.lexbor import LexborHTMLParser, LexborNode
 
 from src.scraper.index import (
+    BATCH_GET_MAX_RETRIES,
     BuildingInfo,
     RoomInfo,
     RoomInfoRegister,
@@ -20,41 +23,162 @@ class TestSuumoScraper:
     def target(self) -> SuumoScraper:
         return SuumoScraper("https://example.com/test?foo=bar&page=5")
 
-    def _get_tag(self, html: str) -> Tag:
-        soup = BeautifulSoup(html, "html.parser")
-        return soup.currentTag()[0]
+    def _get_node(self, html: str, selector: str) -> LexborNode:
+        return LexborHTMLParser(html).css_first(selector)
 
     def test_init(self, target: SuumoScraper) -> None:
         assert target.params == [("foo", "bar")]
+        assert target.page_size == 30
+        assert (
+            target.page_url_prefix == "https://example.com/test?foo=bar&page="
+        )
+
+    def test_init_encodes_params(self) -> None:
+        target = SuumoScraper("https://example.com/test?q=%E6%9D%B1+%26")
+
+        assert target.params == [("q", "東 &")]
+        assert (
+            target.page_url_prefix
+            == "https://example.com/test?q=%E6%9D%B1+%26&page="
+        )
+
+    def test_init_page_size(self) -> None:
+        target = SuumoScraper("https://example.com/test?pc=50")
+
+        assert target.page_size == 50
 
     def test_scrape(self, target: SuumoScraper, mocker: MockerFixture) -> None:
-        mocked_scrape_page = mocker.patch.object(target, "_scrape_page")
-        mocked_scrape_page.side_effect = [
-            [
-                BuildingInfo(
-                    name="ビル",
-                    image_url="https://image.example.com",
-                    address="住所",
-                    accesses=["駅から徒歩1分"],
-                    age="新築",
-                    floor="10階",
-                    room_infos=[],
-                )
-            ],
-            [],
-        ]
+        building_info = BuildingInfo(
+            name="ビル",
+            image_url="https://image.example.com",
+            address="住所",
+            accesses=["駅から徒歩1分"],
+            age="新築",
+            floor="10階",
+            room_infos=[],
+        )
+        mocked_fetch_page = mocker.patch.object(
+            target,
+            "_fetch_page",
+            new_callable=mocker.AsyncMock,
+            return_value=b"<html></html>",
+        )
+        mocker.patch.object(
+            target,
+            "_parse_first_page",
+            return_value=([building_info], 3),
+        )
+        mocked_scrape_page = mocker.patch.object(
+            target,
+            "_scrape_page",
+            new_callable=mocker.AsyncMock,
+            return_value=[building_info],
+        )
+
+        result = target.scrape()
+
+        assert len(result) == 3
+        assert mocked_fetch_page.call_args.args[1] == 1
+        pages = [c.args[1] for c in mocked_scrape_page.call_args_list]
+        assert sorted(pages) == [2, 3]
+
+    @pytest.mark.parametrize(
+        ("buildings", "total_pages", "warned"),
+        [
+            (0, 1, False),
+            (1, None, False),
+            (30, None, True),
+        ],
+    )
+    def test_scrape_single_page(
+        self,
+        target: SuumoScraper,
+        mocker: MockerFixture,
+        buildings: int,
+        total_pages: typing.Optional[int],
+        warned: bool,
+    ) -> None:
+        building_info = BuildingInfo(
+            name="ビル",
+            image_url="https://image.example.com",
+            address="住所",
+            accesses=["駅から徒歩1分"],
+            age="新築",
+            floor="10階",
+            room_infos=[],
+        )
+        mocker.patch.object(
+            target,
+            "_fetch_page",
+            new_callable=mocker.AsyncMock,
+            return_value=b"<html></html>",
+        )
+        mocker.patch.object(
+            target,
+            "_parse_first_page",
+            return_value=([building_info] * buildings, total_pages),
+        )
+        mocked_scrape_page = mocker.patch.object(
+            target,
+            "_scrape_page",
+            new_callable=mocker.AsyncMock,
+        )
+        mocked_logger = mocker.patch("src.scraper.index.logger")
 
         result = target.scrape()
 
-        assert len(result) == 1
-        mocked_scrape_page.assert_has_calls([mocker.call(1), mocker.call(2)])
+        assert len(result) == buildings
+        mocked_scrape_page.assert_not_awaited()
+        assert mocked_logger.warning.called is warned
 
     def test_scrape_page(
         self,
         target: SuumoScraper,
         mocker: MockerFixture,
     ) -> None:
-        html = """
+        session = mocker.MagicMock()
+        mocked_fetch_page = mocker.patch.object(
+            target,
+            "_fetch_page",
+            new_callable=mocker.AsyncMock,
+            return_value=b"<html></html>",
+        )
+        mocked_parse_page = mocker.patch.object(
+            target,
+            "_parse_page",
+            return_value=[],
+        )
+
+        infos = asyncio.run(target._scrape_page(session, 2))
+
+        assert infos == []
+        mocked_fetch_page.assert_awaited_once_with(session, 2)
+        mocked_parse_page.assert_called_once_with(b"<html></html>")
+
+    def test_fetch_page(
+        self,
+        target: SuumoScraper,
+        mocker: MockerFixture,
+    ) -> None:
+        session = mocker.MagicMock()
+        response = session.get.return_value.__aenter__.return_value
+        response.raise_for_status = mocker.Mock()
+        response.read = mocker.AsyncMock(return_value=b"<html></html>")
+
+        html = asyncio.run(target._fetch_page(session, 1))
+
+        assert html == b"<html></html>"
+        session.get.assert_called_once_with(
+            "https://example.com/test?foo=bar&page=1"
+        )
+        response.raise_for_status.assert_called_once_with()
+
+    def test_parse_first_page(
+        self,
+        target: SuumoScraper,
+        mocker: MockerFixture,
+    ) -> None:
+        html = b"""
         <!DOCTYPE html>
         <html lang="en">
         <head>
@@ -63,12 +187,17 @@ class TestSuumoScraper:
         <body>
         <div class="cassetteitem">1</div>
         <div class="cassetteitem">2</div>
+        <div class="pagination pagination_set-nav">
+        <ol class="pagination-parts">
+        <li><span>1</span></li>
+        <li><a href="/test?foo=bar&page=2">2</a></li>
+        <li>...</li>
+        <li><a href="/test?foo=bar&page=12">12</a></li>
+        </ol>
+        </div>
         </body>
         </html>
         """
-        mocked_urlopen = mocker.Mock(return_value=html)
-        mocked_request = mocker.patch("src.scraper.index.request")
-        mocked_request.urlopen = mocked_urlopen
         mocked_scrape_building = mocker.patch.object(
             target,
             "_scrape_building",
@@ -94,25 +223,58 @@ class TestSuumoScraper:
             ),
         ]
 
-        infos = target._scrape_page(1)
+        infos, total_pages = target._parse_first_page(html)
 
+        assert total_pages == 12
         assert len(infos) == 2
         assert infos[0].name == "ビル1"
         assert infos[1].name == "ビル2"
-        mocked_urlopen.assert_called_once_with(
-            "https://example.com/test?foo=bar&page=1"
-        )
         mocked_scrape_building.assert_has_calls(
             [
                 mocker.call(
-                    self._get_tag('<div class="cassetteitem">1</div>'),
+                    self._get_node(
+                        '<div class="cassetteitem">1</div>',
+                        "div.cassetteitem",
+                    ),
                 ),
                 mocker.call(
-                    self._get_tag('<div class="cassetteitem">2</div>'),
+                    self._get_node(
+                        '<div class="cassetteitem">2</div>',
+                        "div.cassetteitem",
+                    ),
                 ),
             ]
         )
 
+    def test_parse_page(
+        self,
+        target: SuumoScraper,
+        mocker: MockerFixture,
+    ) -> None:
+        mocked_parse_buildings = mocker.patch.object(
+            target,
+            "_parse_buildings",
+            return_value=[],
+        )
+        mocked_parse_total_pages = mocker.patch.object(
+            target,
+            "_parse_total_pages",
+        )
+
+        infos = target._parse_page(b"<html></html>")
+
+        assert infos == []
+        mocked_parse_buildings.assert_called_once()
+        mocked_parse_total_pages.assert_not_called()
+
+    def test_parse_total_pages_without_pagination(
+        self,
+        target: SuumoScraper,
+    ) -> None:
+        tree = LexborHTMLParser("<div class='cassetteitem'></div>")
+
+        assert target._parse_total_pages(tree) is None
+
     def test_scrape_building(self, target: SuumoScraper) -> None:
         html = """
         <div class="cassetteitem">
@@ -151,9 +313,9 @@ class TestSuumoScraper:
         </div>
         </div>
         """
-        building_tag = self._get_tag(html)
+        building_node = self._get_node(html, "div.cassetteitem")
 
-        building_info = target._scrape_building(building_tag)
+        building_info = target._scrape_building(building_node)
 
         assert building_info.name == "ビルディング"
         assert building_info.image_url == "https://example.com/image.jpg"
@@ -163,8 +325,35 @@ class TestSuumoScraper:
         assert building_info.floor == "10階建"
         assert building_info.room_infos == []
 
+    def test_scrape_building_nested_markup(
+        self,
+        target: SuumoScraper,
+    ) -> None:
+        html = """
+        <div class="cassetteitem">
+        <div class="cassetteitem_object-item">
+        <img rel="https://example.com/image.jpg" />
+        </div>
+        <div class="cassetteitem_content-title">ビル<span>ディング</span></div>
+        <ul class="cassetteitem_detail">
+        <li class="cassetteitem_detail-col1">東京都<span>どこか</span></li>
+        <li class="cassetteitem_detail-col3">
+        <div>築10年</div>
+        <div>10階建</div>
+        </li>
+        </ul>
+        </div>
+        """
+        building_node = self._get_node(html, "div.cassetteitem")
+
+        building_info = target._scrape_building(building_node)
+
+        assert building_info.name == "ビルディング"
+        assert building_info.address == "東京都どこか"
+
     def test_scrape_room(self, target: SuumoScraper) -> None:
         html = """
+        <table>
         <tbody>
         <tr class="js-cassette_link">
         <td class="cassetteitem_other-checkbox cassetteitem_other-checkbox--newarrival js-cassetteitem_checkbox">
@@ -222,10 +411,11 @@ class TestSuumoScraper:
         </td>
         </tr>
         </tbody>
+        </table>
         """  # noqa
-        room_tag = self._get_tag(html)
+        room_node = self._get_node(html, "tbody")
 
-        room_info = target._scrape_room(room_tag)
+        room_info = target._scrape_room(room_node)
 
         assert room_info.id == "99999999"
         assert room_info.image_urls == [
@@ -306,22 +496,6 @@ class TestRoomInfoRegister:
 
             client.delete_table(TableName=table_name)
 
-    def test_register(
-        self,
-        target: RoomInfoRegister,
-        mocker: MockerFixture,
-    ) -> None:
-        mocked_register_room_info = mocker.patch.object(
-            target, "_register_room_info"
-        )
-
-        target.register()
-
-        mocked_register_room_info.assert_called_once_with(
-            room_info=target.building_infos[0].room_infos[0],
-            building_info=target.building_infos[0],
-        )
-
     @pytest.mark.parametrize(
         ("registered_items", "expected_items"),
         [
@@ -329,7 +503,7 @@ class TestRoomInfoRegister:
             ([{"id": "11111111"}], 2),
         ],
     )
-    def test_register_room_info(
+    def test_register(
         self,
         target: RoomInfoRegister,
         registered_items: typing.List[typing.Dict[str, typing.Any]],
@@ -339,6 +513,143 @@ class TestRoomInfoRegister:
             for item in registered_items:
                 writer.put_item(Item=item)
 
+        target.register()
+
+        res = target.table.scan()
+        assert len(res["Items"]) == expected_items
+        for item in registered_items:
+            assert target.table.get_item(Key=item)["Item"] == item
+
+    def test_register_many(self, target: RoomInfoRegister) -> None:
+        room_info = target.building_infos[0].room_infos[0]
+        target.building_infos = [
+            BuildingInfo(
+                name=f"ビル{i}",
+                image_url="https://image.example.com",
+                address="住所",
+                accesses=["駅から徒歩1分"],
+                age="新築",
+                floor="10階",
+                room_infos=[dataclasses.replace(room_info, id=f"{i:08}")],
+            )
+            for i in range(60)
+        ]
+
+        target.register()
+
+        res = target.table.scan()
+        assert len(res["Items"]) == 60
+
+    def test_register_building_with_rooms(
+        self,
+        target: RoomInfoRegister,
+    ) -> None:
+        building_info = target.building_infos[0]
+        room_info = building_info.room_infos[0]
+        building_info.room_infos.append(
+            dataclasses.replace(room_info, id="11111111")
+        )
+
+        target.register()
+
+        res = target.table.scan()
+        assert len(res["Items"]) == 2
+        for item in res["Items"]:
+            assert item["building_info"]["name"] == "ビル"
+            assert "room_infos" not in item["building_info"]
+        assert len(building_info.room_infos) == 2
+
+    def test_concurrency_fits_connection_pool(
+        self,
+        target: RoomInfoRegister,
+    ) -> None:
+        register = RoomInfoRegister(
+            building_infos=[],
+            table_name=target.table.name,
+            concurrency=100,
+        )
+
+        config = register.table.meta.client.meta.config
+        assert register.concurrency == config.max_pool_connections
+        assert target.concurrency <= config.max_pool_connections
+
+    def test_get_existing_ids(self, target: RoomInfoRegister) -> None:
+        with target.table.batch_writer() as writer:
+            writer.put_item(Item={"id": "00000001"})
+            writer.put_item(Item={"id": "00000150"})
+
+        ids = [f"{i:08}" for i in range(1, 151)]
+        existing_ids = target._get_existing_ids(ids + ids[:10])
+
+        assert existing_ids == {"00000001", "00000150"}
+
+    def test_get_existing_ids_unprocessed_keys(
+        self,
+        target: RoomInfoRegister,
+        mocker: MockerFixture,
+    ) -> None:
+        unprocessed_keys = {
+            target.table.name: {
+                "Keys": [{"id": "00000002"}],
+                "ProjectionExpression": "id",
+            },
+        }
+        mocked_batch_get_item = mocker.patch.object(
+            target.table.meta.client,
+            "batch_get_item",
+            side_effect=[
+                {
+                    "Responses": {target.table.name: [{"id": "00000001"}]},
+                    "UnprocessedKeys": unprocessed_keys,
+                },
+                {
+                    "Responses": {target.table.name: [{"id": "00000002"}]},
+                    "UnprocessedKeys": {},
+                },
+            ],
+        )
+
+        mocked_sleep = mocker.patch("src.scraper.index.time.sleep")
+
+        existing_ids = target._get_existing_ids(
+            ["00000001", "00000002", "00000003"]
+        )
+
+        assert existing_ids == {"00000001", "00000002"}
+        assert mocked_batch_get_item.call_count == 2
+        mocked_batch_get_item.assert_called_with(RequestItems=unprocessed_keys)
+        mocked_sleep.assert_called_once()
+
+    def test_get_existing_ids_retry_exhausted(
+        self,
+        target: RoomInfoRegister,
+        mocker: MockerFixture,
+    ) -> None:
+        unprocessed_keys = {
+            target.table.name: {
+                "Keys": [{"id": "00000001"}],
+                "ProjectionExpression": "id",
+            },
+        }
+        mocked_batch_get_item = mocker.patch.object(
+            target.table.meta.client,
+            "batch_get_item",
+            return_value={
+                "Responses": {target.table.name: []},
+                "UnprocessedKeys": unprocessed_keys,
+            },
+        )
+        mocked_sleep = mocker.patch("src.scraper.index.time.sleep")
+
+        with pytest.raises(RuntimeError):
+            target._get_existing_ids(["00000001"])
+
+        assert mocked_batch_get_item.call_count == BATCH_GET_MAX_RETRIES + 1
+        delays = [c.args[0] for c in mocked_sleep.call_args_list]
+        assert len(delays) == BATCH_GET_MAX_RETRIES
+        assert delays == sorted(delays)
+
+    def test_register_room_info(self, target: RoomInfoRegister) -> None:
         room_info = RoomInfo(
             id="99999999",
             image_urls=["https://example.com/image01.jpg"],
@@ -350,20 +661,22 @@ class TestRoomInfoRegister:
             section_type="1DK",
             area="40.0m2",
         )
-        building_info = BuildingInfo(
-            name="ビル",
-            image_url="https://image.example.com",
-            address="住所",
-            accesses=["駅から徒歩1分"],
-            age="新築",
-            floor="10階",
-            room_infos=[room_info],
-        )
+        building_info_dict = {
+            "name": "ビル",
+            "image_url": "https://image.example.com",
+            "address": "住所",
+            "accesses": ["駅から徒歩1分"],
+            "age": "新築",
+            "floor": "10階",
+        }
 
-        target._register_room_info(
-            room_info=room_info,
-            building_info=building_info,
-        )
+        with target.table.batch_writer() as writer:
+            target._register_room_info(
+                writer=writer,
+                room_info=room_info,
+                building_info_dict=building_info_dict,
+            )
 
-        res = target.table.scan()
-        assert len(res["Items"]) == expected_items
+        res = target.table.get_item(Key={"id": "99999999"})
+        assert res["Item"]["room_info"]["floor"] == "5階"
+        assert res["Item"]["building_info"] == building_info_dict